@@ -2,32 +2,113 @@
 # Licensed under the CC BY-NC 4.0. See LICENSE file in the project root for details.
 
 # Import required libraries for AWS S3 access, date handling, logging, numerical operations, and GRIB file processing
+import asyncio
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore import UNSIGNED
+from botocore.config import Config
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+import functools
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import numpy as np
+import os
 import pandas as pd
 from pathlib import Path
 import pygrib
 import threading
 import time
+from typing import Optional
 
 # List of meteorological variables to extract from GRIB files
 var_names = ['2_metre_temperature', 'surface_pressure', 'geopotential_height_200', 'geopotential_height_500', 'geopotential_height_700']
 
+# GFS initialization times; every date's output holds all of them, whichever a run requests
+ZULUS = ['00', '06', '12', '18']
+
+# Maximum number of GRIB files present at once, counting files being downloaded, waiting for
+# extraction and being extracted; when extraction falls behind, new downloads wait for a slot
+MAX_CONCURRENT_DOWNLOADS = 64
+
+# Number of downloaded files handed to the extraction consumer ahead of a free worker
+PREFETCH_DEPTH = 2
+
+# Fetch each GRIB file as parallel 8 MB ranged GETs rather than a single HTTP stream.
+# With MAX_CONCURRENT_DOWNLOADS files in flight, 4 ranges per file already gives 256 streams.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True,
+)
+
+# Extracted arrays for a whole date are stacked into one raw OUTPUT_DTYPE binary of shape
+# (zulu, forecast_hour, variable, lat, lon), with its layout recorded in a JSON sidecar
+OUTPUT_DTYPE = np.float32
+
+# Value marking missing data in packed int16 output (packing clips to +/-32767); float32 output uses NaN
+INT16_FILL_VALUE = -32768
+
+# (scale_factor, add_offset) used to pack each variable into int16 when quantize is enabled.
+# Steps of 0.01 K, 2 Pa and 0.1 m keep the expected ranges well inside int16.
+PACKING = {
+    '2_metre_temperature': (0.01, 260.0),
+    'surface_pressure': (2.0, 80000.0),
+    'geopotential_height_200': (0.1, 11500.0),
+    'geopotential_height_500': (0.1, 5500.0),
+    'geopotential_height_700': (0.1, 3000.0),
+}
+
+# Geographical bounds for North America in pygrib data() order (lat1, lat2, lon1, lon2):
+# from southern Mexico to northern Canada, and from the Pacific to the Atlantic
+NA_BOUNDS = (15.0, 60.0, 220.0, 305.0)
+
+# Cache of North American crop slices keyed by GRIB grid size (Ni, Nj)
+_CROP_CACHE = {}
+
+# Run configuration of an extraction worker process, set once by init_worker
+_WORKER_ARGS = None
+
+# Start method shared by the extraction pool and the log queue its workers write to; both must
+# come from the same context. Workers are spawned rather than forked: they start after the
+# download threads are running, and a forked child could inherit a lock held by one of them.
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+@dataclass(frozen=True)
 class Args:
     """
-    Simple class to hold command line arguments parsed from config file.
-    Mimics argparse.Namespace for compatibility with main function.
+    Immutable run configuration, built from the config file with Args(**config).
+    Mimics argparse.Namespace for compatibility with main function, and is handed to
+    each extraction worker once through the process pool initializer.
     """
-    def __init__(self, config):
-        self.start_date = config['start_date']
-        self.end_date = config['end_date'] 
-        self.zulus = config.get('zulus', '00,06,12,18')  # Default to standard synoptic times
-        self.resolution = config.get('resolution', '1p00')  # Default to 0.25-degree resolution
-        self.na_bounds = config.get('na_bounds', True)  # Default to using North American bounds
-        self.cleanup = config.get('cleanup', True)  # Default to cleaning up GRIB files after processing
+    start_date: str
+    end_date: str
+    zulus: str = '00,06,12,18'  # Default to standard synoptic times
+    resolution: str = '1p00'  # Default to 1-degree resolution
+    na_bounds: bool = True  # Default to using North American bounds
+    cleanup: bool = True  # Default to cleaning up GRIB files after processing
+    quantize: bool = False  # Default to saving float32 rather than packed int16
+    scratch_dir: Optional[str] = None  # Default to staging GRIB files in the date directory
+    shard: int = 0  # Default to the first (and only) shard
+    num_shards: int = 1  # Default to processing every date in this process
+
+    def __post_init__(self):
+        # A bad shard would otherwise silently process no dates, or the wrong ones
+        if not (self.num_shards >= 1 and 0 <= self.shard < self.num_shards):
+            raise ValueError(f"shard must satisfy 0 <= shard < num_shards with num_shards >= 1, "
+                             f"got shard={self.shard} num_shards={self.num_shards}")
+        unknown = set(self.zulus.split(',')) - set(ZULUS)
+        if unknown:
+            raise ValueError(f"zulus must be drawn from {','.join(ZULUS)}, got {','.join(sorted(unknown))}")
+
+    @property
+    def remove_gribs(self):
+        """Whether GRIB files are deleted after processing; files staged in a scratch directory always are."""
+        return self.cleanup or self.scratch_dir is not None
 
 # Add a logging filter class to include runtime
 class RuntimeFilter(logging.Filter):
@@ -37,69 +118,459 @@ class RuntimeFilter(logging.Filter):
         self.start_time = time.time()
 
     def filter(self, record):
-        record.runtime = f"{time.time() - self.start_time:.2f}s"
+        # Use the record's creation time: the filter runs later, on the QueueListener thread
+        record.runtime = f"{record.created - self.start_time:.2f}s"
         return True
 
-def extract_grib_data(grib_file, grib_index, date, zulu, forecast_hour, na_bounds=True):
+def init_worker(args, log_queue=None):
+    """
+    Initializes an extraction worker process with the run configuration, and sends its log
+    records to the parent's QueueListener if a log queue is given.
+
+    Args:
+        args: Args holding the run configuration
+        log_queue: Optional MP_CONTEXT.Queue drained by the parent's QueueListener
+    """
+    global _WORKER_ARGS
+    _WORKER_ARGS = args
+
+    if log_queue is not None:
+        logger = logging.getLogger()
+        logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+        logger.setLevel(logging.INFO)
+
+def _bounds_slice(coords, lower, upper):
+    """
+    Returns the slice of a sorted (ascending or descending) coordinate vector lying within [lower, upper].
+    """
+    if coords[0] > coords[-1]:
+        # GFS latitudes run north to south, so search the reversed vector and map back
+        n = len(coords)
+        ascending = coords[::-1]
+        start = np.searchsorted(ascending, lower, side='left')
+        stop = np.searchsorted(ascending, upper, side='right')
+        return slice(n - stop, n - start)
+
+    start = np.searchsorted(coords, lower, side='left')
+    stop = np.searchsorted(coords, upper, side='right')
+    return slice(start, stop)
+
+def crop_slices(grib):
+    """
+    Returns the (lat_slice, lon_slice) cropping a GRIB message's grid to North America.
+    The GFS grid is fixed per resolution, so the slices are computed once per grid size and cached.
+    (grib.data(*NA_BOUNDS) is not used: it decodes the full grid and recomputes latlons() on every call.)
+    
+    Args:
+        grib: GRIB message on a regular lat/lon grid
+    """
+    key = (grib.Ni, grib.Nj)
+    if key not in _CROP_CACHE:
+        lat_min, lat_max, lon_min, lon_max = NA_BOUNDS
+
+        grib_lats, grib_lons = grib.latlons()
+        _CROP_CACHE[key] = (_bounds_slice(grib_lats[:, 0], lat_min, lat_max),
+                            _bounds_slice(grib_lons[0, :], lon_min, lon_max))
+
+    return _CROP_CACHE[key]
+
+def extract_grib_data(grib, grib_index, date, zulu, forecast_hour, na_bounds=True, quantize=False):
     """
-    Extracts specific meteorological parameters from a GRIB file and saves them as numpy arrays.
+    Crops a single GRIB message and converts it to the output dtype.
+    Returns the converted array, or None if extraction failed.
     
     Args:
-        grib_file: Open GRIB file handle
-        grib_index: Index of the variable to extract
+        grib: GRIB message holding the variable
+        grib_index: Index of the variable in var_names
         date: Date of the forecast
         zulu: Zulu time (forecast initialization time)
-        forecast_hour: Forecast hour
+        forecast_hour: Forecast hour (int)
         na_bounds: Boolean flag to include North American bounds
+        quantize: Boolean flag to pack the data as int16 using PACKING
     """
     try:
-        # Dispatch table mapping indices to GRIB parameter selection criteria
-        dispatch_table = {
-            0: (grib_file.select, (), {"name": "2 metre temperature"}),
-            1: (grib_file.select, (), {"name": "Surface pressure"}),
-            2: (grib_file.select, (), {"name": "Geopotential height", "level": 200}),
-            3: (grib_file.select, (), {"name": "Geopotential height", "level": 500}),
-            4: (grib_file.select, (), {"name": "Geopotential height", "level": 700}),
-        }
-
-        # Extract the requested parameter using the dispatch table
-        func, args, kwargs = dispatch_table[grib_index]
-        grib = func(*args, **kwargs)[0]
-        
-        # Get the data values and lat/lon coordinates
+        # Get the data values
         grib_data = grib.values
-        grib_lats, grib_lons = grib.latlons()
 
-        # Define geographical bounds for North America
+        # Crop the data to the North American region
         if na_bounds:
-            lat_min, lat_max = 15.0, 60.0  # From southern Mexico to northern Canada
-            lon_min, lon_max = 220.0, 305.0  # From Pacific to Atlantic
-
-            # Find indices for the desired geographical region
-            lat_indices = np.where((grib_lats[:, 0] >= lat_min) & (grib_lats[:, 0] <= lat_max))[0]
-            lon_indices = np.where((grib_lons[0, :] >= lon_min) & (grib_lons[0, :] <= lon_max))[0]
-
-            # Crop the data to the desired region
-            cropped_grib_data = grib_data[np.min(lat_indices):np.max(lat_indices) + 1,
-                                        np.min(lon_indices):np.max(lon_indices) + 1]
-                
-            # Update path handling to ensure cross-platform compatibility
-            data_dir = Path('data').resolve() / date.strftime("%Y%m%d")
-            data_dir.mkdir(parents=True, exist_ok=True)
-            
-            # Use Path for binary file path construction
-            binary_file = data_dir / f'{Path(grib_file.name).name}_{var_names[grib_index]}.npy'
-            np.save(binary_file, cropped_grib_data if na_bounds else grib_data)
-        else:
-            # Save the data as a numpy binary file
-            binary_file = data_dir / f'{grib_file.name}_{var_names[grib_index]}.npy'
-            np.save(binary_file, grib_data)
+            lat_slice, lon_slice = crop_slices(grib)
+            grib_data = grib_data[lat_slice, lon_slice]
+
+        if quantize:
+            # Unpack with: value = packed * scale_factor + add_offset
+            scale_factor, add_offset = PACKING[var_names[grib_index]]
+            packed = np.round((grib_data - add_offset) / scale_factor)
+            return np.clip(packed, -32767, 32767).astype(np.int16)
+
+        # The crop is a strided view into the global grid; copy it into a compact C-contiguous
+        # array, downcasting in the same pass, so later stacking and readers see contiguous rows
+        return np.ascontiguousarray(grib_data, dtype=OUTPUT_DTYPE)
 
     except Exception as e:
-        logging.error("Error extracting grib file for %s %s %s %s: %s", 
+        logging.error("Error extracting grib file for %s %s %03d %s: %s", 
                      date, zulu, forecast_hour, var_names[grib_index], e)
+        return None
+
+def extract_all(grib_index_file, date, zulu, forecast_hour, na_bounds=True, quantize=False):
+    """
+    Extracts every variable in var_names from a GRIB file by looking each one up in its (name, level) index.
+    Returns a (variable, lat, lon) array with missing variables filled, or None if nothing was extracted,
+    together with the names of the variables that were found.
+    
+    Args:
+        grib_index_file: pygrib.index of the GRIB file keyed on 'name' and 'level'
+        date: Date of the forecast
+        zulu: Zulu time (forecast initialization time)
+        forecast_hour: Forecast hour (int)
+        na_bounds: Boolean flag to include North American bounds
+        quantize: Boolean flag to pack the data as int16 using PACKING
+    """
+    # Index selection criteria for each variable in var_names; an index lookup needs every
+    # indexed key, so the single-level fields use their fixed levels (2 m above ground, surface)
+    selections = [
+        {"name": "2 metre temperature", "level": 2},
+        {"name": "Surface pressure", "level": 0},
+        {"name": "Geopotential height", "level": 200},
+        {"name": "Geopotential height", "level": 500},
+        {"name": "Geopotential height", "level": 700},
+    ]
+
+    extracted = {}
+    for grib_index, selection in enumerate(selections):
+        try:
+            grib = grib_index_file.select(**selection)[0]
+        except ValueError:
+            logging.error("Error extracting grib file for %s %s %03d %s: %s", 
+                         date, zulu, forecast_hour, var_names[grib_index], "no matching message")
+            continue
+
+        grib_data = extract_grib_data(grib, grib_index, date, zulu, forecast_hour, na_bounds, quantize)
+        if grib_data is not None:
+            extracted[grib_index] = grib_data
+
+    found = [var_names[grib_index] for grib_index in sorted(extracted)]
+    if not extracted:
+        return None, found
+
+    # Every variable shares the same grid, so stack them into one array
+    sample = next(iter(extracted.values()))
+    stacked = np.full((len(var_names),) + sample.shape, INT16_FILL_VALUE if quantize else np.nan, dtype=sample.dtype)
+    for grib_index, grib_data in extracted.items():
+        stacked[grib_index] = grib_data
+    return stacked, found
+
+def process_grib_file(grib_path, date, zulu, forecast_hour):
+    """
+    Opens a downloaded GRIB file, extracts every variable in var_names from it and deletes it.
+    Runs inside a worker process (set up by init_worker) so decoding does not block the download
+    event loop. Returns the (variable, lat, lon) array and found variable names from extract_all.
+
+    Args:
+        grib_path: Path to the downloaded GRIB file
+        date: Date of the forecast
+        zulu: Zulu time (forecast initialization time)
+        forecast_hour: Forecast hour (int)
+    """
+    args = _WORKER_ARGS
+    try:
+        # Index only the name and level keys of each message instead of reading every message in full
+        gribs = pygrib.index(str(grib_path), 'name', 'level')
+        try:
+            return extract_all(gribs, date, zulu, forecast_hour, args.na_bounds, args.quantize)
+        finally:
+            gribs.close()
+    finally:
+        # Only cleanup if specified in config
+        if args.remove_gribs:
+            Path(grib_path).unlink(missing_ok=True)
+            logging.info(f"Deleted processed file: {grib_path}")
+
+def _key_prefixes(date_str, zulu, resolution):
+    """
+    Returns the (S3 key, local file name) prefixes shared by every forecast hour of one date and zulu.
+    Appending the three-digit forecast hour to either gives the full key or file name.
+    """
+    file_prefix = f'gfs.t{zulu}z.pgrb2.{resolution}.f'
+    return f'gfs.{date_str}/{zulu}/atmos/{file_prefix}', file_prefix
+
+class DayStack:
+    """
+    Collects the extracted arrays of one date into a single (zulu, forecast_hour, variable, lat, lon)
+    file, written in place through a memmap, plus a JSON sidecar describing its layout and which
+    (zulu, forecast_hour) slots are complete. The sidecar is rewritten after every slot, so a rerun
+    with the same layout resumes from it even if the previous run was interrupted mid-date.
+    The zulu axis always spans ZULUS, so runs for different zulus fill the same file side by side.
+    Its methods block on disk I/O, so they are run on a thread pool and serialized by a lock.
+    """
+    def __init__(self, out_dir, args, forecast_hours):
+        self.data_file = out_dir / f'gfs.pgrb2.{args.resolution}.bin'
+        self.metadata_file = out_dir / f'gfs.pgrb2.{args.resolution}.json'
+        self.layout = {
+            'zulus': ZULUS,
+            'forecast_hours': list(forecast_hours),
+            'var_names': var_names,
+            'dtype': np.dtype(np.int16 if args.quantize else OUTPUT_DTYPE).name,
+            'na_bounds': args.na_bounds,
+        }
+        self.quantize = args.quantize
+        self.shape = None
+        self.complete = set()
+        self.pending = 0
+        self._data = None
+        self._lock = threading.RLock()
+
+        # Resume from a previous run if it wrote the same layout
+        if self.metadata_file.exists() and self.data_file.exists():
+            with open(self.metadata_file, 'r') as f:
+                metadata = json.load(f)
+            if all(metadata.get(key) == value for key, value in self.layout.items()):
+                self.shape = tuple(metadata['shape'])
+                self.complete = {tuple(slot) for slot in metadata['complete']}
+            else:
+                # Never truncate extracted data: changing na_bounds, quantize or the layout needs a fresh file
+                raise FileExistsError(f"{self.data_file} was written with a different layout than this run; "
+                                      f"move it aside or restore the previous settings")
+
+    def write(self, zulu, forecast_hour, stacked, complete=True):
+        """
+        Stores the (variable, lat, lon) array for one zulu and forecast hour. The slot is only
+        recorded as complete if `complete` is set, so a partial extraction is retried on the next run.
+        """
+        with self._lock:
+            if self._data is None:
+                if self.shape is None:
+                    self.shape = (len(self.layout['zulus']), len(self.layout['forecast_hours'])) + stacked.shape
+                    self._data = np.memmap(self.data_file, dtype=stacked.dtype, mode='w+', shape=self.shape)
+                    self._data[:] = INT16_FILL_VALUE if self.quantize else np.nan
+                else:
+                    self._data = np.memmap(self.data_file, dtype=stacked.dtype, mode='r+', shape=self.shape)
+
+            self._data[self.layout['zulus'].index(zulu), self.layout['forecast_hours'].index(forecast_hour)] = stacked
+            if complete:
+                self.complete.add((zulu, forecast_hour))
+
+            # Persist the slot before recording it as complete
+            self._data.flush()
+            self._write_metadata()
+
+    def job_done(self):
+        """Marks one scheduled job as finished (successfully or not), closing the file after the last one."""
+        with self._lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.close()
+
+    def close(self):
+        """Flushes the array and writes the sidecar, if anything was written."""
+        with self._lock:
+            if self._data is None:
+                return
+            self._data.flush()
+            self._data = None
+            self._write_metadata()
 
-def main(args):
+    def _write_metadata(self):
+        """Atomically replaces the sidecar, so an interruption never leaves it half-written."""
+        metadata = dict(self.layout, shape=list(self.shape), complete=sorted(self.complete))
+        if self.quantize:
+            metadata['fill_value'] = INT16_FILL_VALUE
+            metadata['packing'] = {name: {'scale_factor': scale_factor, 'add_offset': add_offset}
+                                   for name, (scale_factor, add_offset) in PACKING.items()}
+
+        tmp_file = self.metadata_file.with_name(self.metadata_file.name + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_file, self.metadata_file)
+
+async def fetch(sem, downloader, s3, bucket, s3_file, grib_path, stack, job, queue):
+    """
+    Downloads a single GRIB file from S3 and hands its path to the processing queue.
+    The file's slot in `sem` is released by extract once the file has been processed.
+
+    Args:
+        sem: Semaphore capping the number of GRIB files present at once
+        downloader: ThreadPoolExecutor the blocking boto3 download runs on
+        s3: boto3 S3 client
+        bucket: Name of the S3 bucket
+        s3_file: Key of the GRIB file in the bucket
+        grib_path: Local path to download the GRIB file to
+        stack: DayStack the extracted arrays are written to
+        job: (date, zulu, forecast_hour) tuple identifying the file
+        queue: Bounded asyncio.Queue of downloaded files awaiting extraction
+    """
+    date, zulu, forecast_hour = job
+    loop = asyncio.get_running_loop()
+
+    await sem.acquire()
+    logging.info("Downloading grib file for %s %s %03d", date, zulu, forecast_hour)
+    try:
+        # boto3 calls block but release the GIL during socket I/O, so run them on a thread pool
+        await loop.run_in_executor(downloader, functools.partial(
+            s3.download_file, bucket, s3_file, str(grib_path), Config=TRANSFER_CONFIG))
+    except Exception as e:
+        logging.error("Error downloading grib file for %s %s %03d: %s", 
+                    date, zulu, forecast_hour, e)
+        sem.release()
+        await loop.run_in_executor(None, stack.job_done)
+        return
+
+    # Keep the slot until extraction has finished with the file, so downloads never
+    # run more than MAX_CONCURRENT_DOWNLOADS files ahead of extraction
+    await queue.put((job, grib_path, stack, sem))
+
+async def extract(sem, pool, job, grib_path, stack, file_sem, remove_gribs):
+    """
+    Extracts a single downloaded GRIB file in the process pool, stores the result in its
+    date's DayStack and frees its worker slot and file slot.
+
+    Args:
+        sem: Semaphore slot (already acquired) for a pool worker
+        pool: ProcessPoolExecutor used for extraction
+        job: (date, zulu, forecast_hour) tuple identifying the file
+        grib_path: Path to the downloaded GRIB file
+        stack: DayStack the extracted arrays are written to
+        file_sem: Semaphore slot (already acquired by fetch) for the GRIB file
+        remove_gribs: Whether to delete the GRIB file if the worker could not
+    """
+    date, zulu, forecast_hour = job
+    loop = asyncio.get_running_loop()
+
+    try:
+        try:
+            stacked, found = await loop.run_in_executor(pool, process_grib_file, grib_path, date, zulu, forecast_hour)
+        except Exception:
+            # The worker deletes the file itself, but not if the pool fails before or after running it
+            if remove_gribs:
+                Path(grib_path).unlink(missing_ok=True)
+            raise
+        if len(found) < len(var_names):
+            logging.warning("Only extracted %d of %d variables for %s %s %03d; it will be retried on the next run",
+                            len(found), len(var_names), date, zulu, forecast_hour)
+        if stacked is not None:
+            # Creating the memmap fills the whole date's array, so keep it and the slot
+            # writes off the event loop thread on the loop's default executor
+            await loop.run_in_executor(None, functools.partial(
+                stack.write, zulu, forecast_hour, stacked, complete=len(found) == len(var_names)))
+    except Exception as e:
+        logging.error("Error processing grib file for %s %s %03d: %s", 
+                    date, zulu, forecast_hour, e)
+    finally:
+        sem.release()
+        file_sem.release()
+        await loop.run_in_executor(None, stack.job_done)
+
+async def process(queue, pool, workers, remove_gribs):
+    """
+    Consumes downloaded GRIB files from the queue and extracts up to `workers` of them in parallel.
+
+    Args:
+        queue: asyncio.Queue of ((date, zulu, forecast_hour), grib_path, stack, file_sem) items, terminated by None
+        pool: ProcessPoolExecutor used for extraction
+        workers: Number of worker processes in the pool
+        remove_gribs: Whether GRIB files are deleted after processing
+    """
+    # Only take files off the queue when a worker is free, so at most PREFETCH_DEPTH files wait in it
+    sem = asyncio.Semaphore(workers)
+    tasks = set()
+
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+
+        await sem.acquire()
+        job, grib_path, stack, file_sem = item
+        task = asyncio.create_task(extract(sem, pool, job, grib_path, stack, file_sem, remove_gribs))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks)
+
+async def run(args, jobs, forecast_hours, data_dir, grib_dir, log_queue=None):
+    """
+    Downloads all requested GRIB files concurrently while extracting completed ones.
+
+    Args:
+        args: Object holding the run configuration (see main)
+        jobs: List of (date, zulu, forecast_hour) tuples to download and process
+        forecast_hours: Forecast hours making up the second axis of each date's stacked output
+        data_dir: Root directory for extracted data
+        grib_dir: Root directory GRIB files are downloaded to
+        log_queue: Optional MP_CONTEXT.Queue that worker processes send log records to
+    """
+    resolution = args.resolution
+
+    # Initialize a single AWS S3 client for accessing NOAA GFS data, shared by all download threads.
+    # The connection pool has room for every ranged GET of every download in flight, so no
+    # connection is opened only to be discarded; retries back off adaptively when S3 throttles,
+    # and requests are left unsigned since the NOAA bucket is public.
+    s3 = boto3.client('s3', config=Config(
+        max_pool_connections=MAX_CONCURRENT_DOWNLOADS * TRANSFER_CONFIG.max_concurrency,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+        tcp_keepalive=True,
+        signature_version=UNSIGNED,
+    ))
+    bucket = 'noaa-gfs-bdp-pds'
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    queue = asyncio.Queue(maxsize=PREFETCH_DEPTH)
+
+    # Extraction is CPU-bound (GRIB2 decompression), so run one worker process per core (see MP_CONTEXT).
+    # Downloads get their own thread pool: the loop's default executor only has
+    # min(32, cpu_count + 4) threads, which would cap downloads below MAX_CONCURRENT_DOWNLOADS.
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT,
+                             initializer=init_worker, initargs=(args, log_queue)) as pool, \
+            ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as downloader:
+        consumer = asyncio.create_task(process(queue, pool, workers, args.remove_gribs))
+
+        fetches = []
+        stacks = []
+        skipped = 0
+        current_date = current_zulu = None
+        forecast_hour_strs = {forecast_hour: f'{forecast_hour:03d}' for forecast_hour in forecast_hours}
+        for date, zulu, forecast_hour in jobs:
+            # Jobs are grouped by date, so format the date and open its output once per date
+            if date != current_date:
+                current_date, current_zulu = date, None
+                date_str = date.strftime("%Y%m%d")
+                date_grib_dir = grib_dir / date_str
+                stack = DayStack(data_dir / date_str, args, forecast_hours)
+                stacks.append(stack)
+
+            # ...and by zulu within a date, so build the key and file name prefixes once per zulu
+            if zulu != current_zulu:
+                current_zulu = zulu
+                key_prefix, file_prefix = _key_prefixes(date_str, zulu, resolution)
+
+            # Skip files already extracted by a previous (possibly interrupted) run
+            if (zulu, forecast_hour) in stack.complete:
+                skipped += 1
+                continue
+
+            forecast_hour_str = forecast_hour_strs[forecast_hour]
+            s3_file = key_prefix + forecast_hour_str
+
+            # Update path handling for grib files
+            grib_path = date_grib_dir / (file_prefix + forecast_hour_str)
+            stack.pending += 1
+            fetches.append(fetch(sem, downloader, s3, bucket, s3_file, grib_path, stack, (date, zulu, forecast_hour), queue))
+
+        if skipped:
+            logging.info("Skipping %d grib files with existing outputs", skipped)
+
+        await asyncio.gather(*fetches)
+
+        # Signal the consumer that no more files are coming and wait for it to drain the queue
+        await queue.put(None)
+        await consumer
+
+        # Every stack closes itself after its last job; this only matters if a job never finished
+        for stack in stacks:
+            stack.close()
+
+def main(args, log_queue=None):
     """
     Main function to download and process GRIB files from NOAA GFS (Global Forecast System).
     
@@ -110,9 +581,15 @@ def main(args):
             - zulus (str): Comma-separated list of initialization times (00,06,12,18)
             - resolution (str): Spatial resolution of the forecast (like '0p25' for 0.25 degrees, '0p50' for 0.5 degrees, '1p00' for 1 degree)
             - na_bounds (bool): Whether to crop data to North American bounds
+            - quantize (bool): Whether to pack data as int16 instead of float32
+            - scratch_dir (str or None): Directory to stage GRIB files in, such as /dev/shm
+            - shard (int): Index of the date shard this process handles (0 <= shard < num_shards)
+            - num_shards (int): Number of shards the date range is split into
+        log_queue: Optional MP_CONTEXT.Queue that worker processes send log records to
     """
 
-    logging.info("Starting run for %s to %s", args.start_date, args.end_date)
+    logging.info("Starting run for %s to %s (shard %d of %d)", args.start_date, args.end_date,
+                 args.shard, args.num_shards)
 
     # Update path handling
     data_dir = Path('data').resolve()
@@ -122,51 +599,29 @@ def main(args):
     start_date = datetime.strptime(args.start_date, '%Y%m%d')
     end_date = datetime.strptime(args.end_date, '%Y%m%d')
     date_range = pd.date_range(start=start_date, end=end_date, freq='D')
+
+    # Dates are independent, so a long range can be split across processes or hosts:
+    # each shard takes every num_shards-th date and builds its own S3 client and worker pool
+    date_range = date_range[args.shard::args.num_shards]
     zulus = args.zulus.split(',')
-    resolution = args.resolution
     
-    # Generate forecast hours from 0 to 180 in 3-hour intervals
-    forecast_hours = [f'{i:03d}' for i in range(0, 385, 3)]
+    # Generate forecast hours from 0 to 384 in 3-hour intervals (formatted once, when building keys)
+    forecast_hours = range(0, 385, 3)
 
-    # Initialize AWS S3 client for accessing NOAA GFS data
-    s3 = boto3.client('s3')
-    bucket = 'noaa-gfs-bdp-pds'
+    # Stage GRIB files in the scratch directory if configured (e.g. /dev/shm, to skip a disk
+    # write and read per file), otherwise next to the extracted data
+    grib_dir = Path(args.scratch_dir).resolve() if args.scratch_dir is not None else data_dir
 
-    # Process each combination of date, initialization time, and forecast hour
+    # Create date-specific directories under data up front so downloads can land in any order
     for date in date_range:
-        # Create date-specific directory under data
         date_dir = data_dir / date.strftime("%Y%m%d")
         date_dir.mkdir(exist_ok=True)
+        (grib_dir / date.strftime("%Y%m%d")).mkdir(parents=True, exist_ok=True)
+
+    # Build every combination of date, initialization time, and forecast hour to process
+    jobs = [(date, zulu, forecast_hour) for date in date_range for zulu in zulus for forecast_hour in forecast_hours]
 
-        for zulu in zulus:
-            for forecast_hour in forecast_hours:
-                logging.info("Downloading grib file for %s %s %s", date, zulu, forecast_hour)
-                try:
-                    # Update path handling for grib files
-                    grib_path = date_dir / f'gfs.t{zulu}z.pgrb2.{resolution}.f{forecast_hour}'
-                    s3_file = f'gfs.{date.strftime("%Y%m%d")}/{zulu}/atmos/gfs.t{zulu}z.pgrb2.{resolution}.f{forecast_hour}'
-                    s3.download_file(bucket, s3_file, str(grib_path))
-                
-                except Exception as e:
-                    logging.error("Error downloading grib file for %s %s %s: %s", 
-                                date, zulu, forecast_hour, e)
-                    continue    
-
-                # Process the GRIB file using multiple threads for parallel extraction
-                gribs = pygrib.open(str(grib_path))
-
-                threads = []
-                for var_index in range(len(var_names)):
-                    thread = threading.Thread(target=extract_grib_data, args=(gribs, var_index, date, zulu, forecast_hour, args.na_bounds))
-                    threads.append(thread)
-                    thread.start()
-                for thread in threads:
-                    thread.join()
-
-                # Only cleanup if specified in config
-                if args.cleanup:
-                    Path(grib_path).unlink()
-                    logging.info(f"Deleted processed file: {grib_path}")
+    asyncio.run(run(args, jobs, forecast_hours, data_dir, grib_dir, log_queue))
 
     logging.info("Ending run for %s to %s", args.start_date, args.end_date)
 
@@ -180,7 +635,12 @@ if __name__ == '__main__':
     with open(config_path, 'r') as f:
         config = json.load(f)
     
-    log_filename = log_dir / f"grib_{config['start_date']}_to_{config['end_date']}.log"
+    # Initialize arguments
+    args = Args(**config)
+
+    # Give each shard its own log file so concurrent shards do not interleave writes
+    shard_suffix = f"_shard{args.shard}of{args.num_shards}" if args.num_shards > 1 else ""
+    log_filename = log_dir / f"grib_{config['start_date']}_to_{config['end_date']}{shard_suffix}.log"
     file_handler = logging.FileHandler(str(log_filename), mode="a")
     file_handler.setLevel(logging.INFO)
     
@@ -203,12 +663,19 @@ if __name__ == '__main__':
     file_handler.addFilter(runtime_filter)
     console_handler.addFilter(runtime_filter)
     
-    # Add handlers to logger
+    # Route records through a queue so download threads and worker processes only enqueue them;
+    # a single listener thread does the formatting and file/console writes
+    log_queue = MP_CONTEXT.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    # Add queue handler to logger
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-    # Initialize arguments and execute main processing function
-    args = Args(config)
-    main(args)
\ No newline at end of file
+    # Execute main processing function
+    try:
+        main(args, log_queue)
+    finally:
+        listener.stop()
\ No newline at end of file